@@ -5,14 +5,17 @@ Processes multiple articles concurrently for much faster throughput
 """
 
 import os
-import json
+import orjson
 import re
 import asyncio
+import sqlite3
 from pathlib import Path
-from typing import Dict, List, Optional
+from typing import Dict, List, Optional, Set, Tuple
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
 from dotenv import load_dotenv
-from xml.etree import ElementTree as ET
-from anthropic import AsyncAnthropic
+from lxml import etree as ET
+import httpx
+from anthropic import AsyncAnthropic, DefaultAsyncHttpxClient
 import time
 
 # Load environment variables
@@ -22,93 +25,425 @@ load_dotenv()
 XML_DIR = Path("pubmed-articles/xmls")
 SUMMARIES_DIR = Path("pubmed-articles/summaries")
 SUMMARIES_DIR.mkdir(parents=True, exist_ok=True)
+INDEX_FILE = SUMMARIES_DIR / "all_analyses_index.json"
+# SQLite store the index is exported from; kept outside SUMMARIES_DIR so upload_to_gcs.py never syncs it
+ANALYSES_DB = SUMMARIES_DIR.parent / "analyses.db"
 
 # Claude API setup
 CLAUDE_API_KEY = os.getenv('CLAUDE_API_KEY')
 if not CLAUDE_API_KEY:
     raise ValueError("CLAUDE_API_KEY not found in .env file")
 
+# Shared client so the HTTP connection pool stays warm for the whole run
+CLIENT = AsyncAnthropic(
+    api_key=CLAUDE_API_KEY,
+    timeout=httpx.Timeout(600.0, connect=10.0),
+    http_client=DefaultAsyncHttpxClient(
+        limits=httpx.Limits(max_connections=100, max_keepalive_connections=50, keepalive_expiry=60)
+    )
+)
+
 # Parallel processing settings
 MAX_CONCURRENT_ARTICLES = 5  # Process 5 articles at once, 20 will give you rate limited errors 429
-MAX_CONCURRENT_STAGES = 4    # All 4 stages can run in parallel per article
+MAX_CONCURRENT_STAGES = 3    # Stages 1-3 run in parallel once stage 4 has warmed the prompt cache
+
+# XML elements whose text is extracted from each article
+XML_TEXT_TAGS = ('article-title', 'abstract', 'body')
+
+# Precompiled patterns used on every article
+WHITESPACE_RE = re.compile(r'\s+')
+PMID_RE = re.compile(r'PMID(\d+)')
+
+# Article text sent to Claude is truncated to this many characters
+MAX_ARTICLE_CHARS = 300000
+
+# Output token limits per stage
+STAGE_MAX_TOKENS = {1: 8192, 2: 4096, 3: 4096, 4: 2048}
+
+# Message Batches API settings (--batch mode)
+BATCH_ARTICLES = 50          # Articles per batch job (4 requests each), keeps payload well under 256MB
+MAX_CONCURRENT_BATCH_SUBMITS = 4  # Chunks being prepared/submitted at once (bounds article text in memory)
+BATCH_POLL_INITIAL = 30      # Seconds before the first status poll
+BATCH_POLL_MAX = 600         # Cap for exponential poll backoff
+
+# Anthropic rate limits: request rate and input tokens/minute, with a rough chars-per-token estimate
+MAX_REQUESTS_PER_SECOND = 50
+TOKENS_PER_MINUTE = 450000
+CHARS_PER_TOKEN = 4
+
+
+class TokenRateLimiter:
+    """Token bucket allowing max_rate units per time_period seconds, refilled continuously"""
+
+    def __init__(self, max_rate: int, time_period: float = 60):
+        """Initialize a full bucket"""
+        self.capacity = max_rate
+        self.tokens = float(max_rate)
+        self.refill_per_second = max_rate / time_period
+        self.updated_at = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self, amount: int = 1):
+        """Wait until `amount` tokens are available, then consume them"""
+        amount = min(amount, self.capacity)
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity,
+                                  self.tokens + (now - self.updated_at) * self.refill_per_second)
+                self.updated_at = now
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                await asyncio.sleep((amount - self.tokens) / self.refill_per_second)
+
+
+def clean_xml_text(xml_path: str) -> Dict[str, str]:
+    """
+    Extract and clean text sections from XML article in a single streaming pass.
+    Module-level so it can be pickled and run in the XML process pool.
+    """
+    try:
+        title = None
+        abstract_parts = []
+        body_parts = []
+
+        # Whitespace-only nodes, comments and PIs are dropped by the parser itself
+        for _, elem in ET.iterparse(xml_path, events=('end',), tag=XML_TEXT_TAGS,
+                                    huge_tree=True, recover=True, remove_blank_text=True,
+                                    remove_comments=True, remove_pis=True):
+            text = ' '.join(part.strip() for part in elem.itertext() if part.strip())
+            if elem.tag == 'article-title':
+                # Only the first title is the article's own; later ones are references
+                if title is None:
+                    title = text
+            elif text:
+                (abstract_parts if elem.tag == 'abstract' else body_parts).append(text)
+
+            # Free the consumed subtree, unless an enclosing abstract/body still needs it
+            if next(elem.iterancestors(*XML_TEXT_TAGS), None) is None:
+                elem.clear()
+                while elem.getprevious() is not None:
+                    del elem.getparent()[0]
+
+        title = title or ''
+        abstract = ' '.join(abstract_parts)
+        body = ' '.join(body_parts)
+
+        # Clean up whitespace
+        title = WHITESPACE_RE.sub(' ', title).strip()
+        abstract = WHITESPACE_RE.sub(' ', abstract).strip()
+        body = WHITESPACE_RE.sub(' ', body).strip()
+
+        return {'title': title, 'abstract': abstract, 'body': body}
+
+    except Exception as e:
+        print(f"    ✗ Error parsing XML: {e}")
+        return {'title': '', 'abstract': '', 'body': ''}
+
+
+def find_json_span(text: str, opener: str, closer: str) -> Optional[str]:
+    """Slice from the first opener to the last closer, or None if either is missing"""
+    start = text.find(opener)
+    end = text.rfind(closer)
+    if start == -1 or end < start:
+        return None
+    return text[start:end + 1]
+
+
+class JsonScanner:
+    """
+    Incrementally scan text for the first complete top-level JSON value starting
+    with `opener` that parses, skipping bracketed prose such as "Sure [see below]:"
+    """
+
+    def __init__(self, opener: str):
+        """Start an empty scan"""
+        self.opener = opener
+        self.parts = []
+        self.length = 0
+        self.depth = 0
+        self.start = 0
+        self.in_string = self.escaped = False
+
+    def text(self) -> str:
+        """All text fed so far"""
+        if len(self.parts) > 1:
+            self.parts = [''.join(self.parts)]
+        return self.parts[0] if self.parts else ''
+
+    def feed(self, chunk: str) -> Optional[str]:
+        """Add text; return the JSON text as soon as a matching value is complete"""
+        offset = self.length
+        self.parts.append(chunk)
+        self.length += len(chunk)
+        for i, char in enumerate(chunk):
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif char == '\\':
+                    self.escaped = True
+                elif char == '"':
+                    self.in_string = False
+            elif char == '"' and self.depth:
+                self.in_string = True
+            elif char in '[{':
+                if not self.depth:
+                    self.start = offset + i
+                self.depth += 1
+            elif char in ']}' and self.depth:
+                self.depth -= 1
+                if not self.depth:
+                    candidate = self.text()[self.start:offset + i + 1]
+                    if candidate[0] == self.opener:
+                        try:
+                            orjson.loads(candidate)
+                            return candidate
+                        except orjson.JSONDecodeError:
+                            pass  # Prose in brackets; keep scanning
+        return None
+
+
+def parse_json_value(text: str, opener: str, closer: str):
+    """
+    Parse the JSON value in a response: the outermost opener..closer span if it parses,
+    otherwise the first top-level value that does. None if there is no span at all.
+    """
+    json_text = find_json_span(text, opener, closer)
+    if json_text is None:
+        return None
+    try:
+        return orjson.loads(json_text)
+    except orjson.JSONDecodeError:
+        found = JsonScanner(opener).feed(text)
+        if found is None:
+            raise
+        return orjson.loads(found)
+
+
+def find_processed_pmids() -> Set[str]:
+    """Collect PMIDs that already have an analysis file, in a single directory scan (no per-file stat)"""
+    prefix, suffix = "PMID", "_analysis.json"
+    with os.scandir(SUMMARIES_DIR) as entries:
+        return {
+            entry.name[len(prefix):-len(suffix)]
+            for entry in entries
+            if entry.name.startswith(prefix) and entry.name.endswith(suffix)
+        }
+
+
+def scan_analysis_files() -> Dict[str, Tuple[str, int]]:
+    """Map PMID -> (path, mtime_ns) for every analysis file; costs one stat() per file"""
+    prefix, suffix = "PMID", "_analysis.json"
+    with os.scandir(SUMMARIES_DIR) as entries:
+        return {
+            entry.name[len(prefix):-len(suffix)]: (entry.path, entry.stat().st_mtime_ns)
+            for entry in entries
+            if entry.name.startswith(prefix) and entry.name.endswith(suffix)
+        }
+
+
+class AnalysisStore:
+    """
+    SQLite store of analyses keyed by PMID, kept in step with the per-article
+    analysis files. All access goes through one dedicated thread, so SQLite
+    always has a single writer.
+    """
+
+    def __init__(self, db_path: Path):
+        """Open (or create) the database in WAL mode"""
+        self.db_path = db_path
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.conn = None
+        self._run(self._connect)
+
+    def _run(self, func, *args):
+        """Run func on the store thread and wait for its result"""
+        return self.executor.submit(func, *args).result()
+
+    def _connect(self):
+        self.conn = sqlite3.connect(str(self.db_path), isolation_level=None)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        # mtime_ns is the analysis file's mtime when the row was stored, to detect later edits
+        self.conn.execute('CREATE TABLE IF NOT EXISTS analyses '
+                          '(pmid TEXT PRIMARY KEY, json BLOB NOT NULL, mtime_ns INTEGER NOT NULL)')
+        # Summaries directory mtime and file count as of the last time the store matched it
+        self.conn.execute('CREATE TABLE IF NOT EXISTS sync_state '
+                          '(id INTEGER PRIMARY KEY CHECK (id = 0), dir_mtime_ns INTEGER NOT NULL, '
+                          'file_count INTEGER NOT NULL)')
+
+    def _write(self, rows: List[Tuple[str, bytes, int]], removed: List[str],
+               sync_state: Optional[Tuple[int, int]] = None):
+        self.conn.execute('BEGIN')
+        try:
+            self.conn.executemany('INSERT OR REPLACE INTO analyses (pmid, json, mtime_ns) VALUES (?, ?, ?)', rows)
+            self.conn.executemany('DELETE FROM analyses WHERE pmid = ?', [(pmid,) for pmid in removed])
+            if sync_state is not None:
+                self.conn.execute('INSERT OR REPLACE INTO sync_state VALUES (0, ?, ?)', sync_state)
+        except Exception:
+            self.conn.execute('ROLLBACK')
+            raise
+        self.conn.execute('COMMIT')
+
+    def _sync_state(self) -> Optional[Tuple[int, int]]:
+        return self.conn.execute('SELECT dir_mtime_ns, file_count FROM sync_state').fetchone()
+
+    def _mtimes(self) -> Dict[str, int]:
+        return dict(self.conn.execute('SELECT pmid, mtime_ns FROM analyses'))
+
+    def _load_all(self) -> List[bytes]:
+        return [row[0] for row in self.conn.execute('SELECT json FROM analyses ORDER BY pmid')]
+
+    def _save(self, output_file: Path, result: Dict):
+        recorded = self._sync_state()
+        dir_mtime_ns = SUMMARIES_DIR.stat().st_mtime_ns
+        is_new = not output_file.exists()
+
+        data = orjson.dumps(result)
+        output_file.write_bytes(data)
+
+        # If nothing else has touched the directory since the last record, this write is the
+        # only change, so carry the record forward instead of forcing a full sync next run
+        sync_state = None
+        if recorded is not None and recorded[0] == dir_mtime_ns:
+            sync_state = (SUMMARIES_DIR.stat().st_mtime_ns, recorded[1] + is_new)
+        self._write([(result['pmid'], data, output_file.stat().st_mtime_ns)], [], sync_state)
+
+    def save(self, output_file: Path, result: Dict):
+        """Write an analysis file and record it in the store; safe to call from any thread"""
+        self._run(self._save, output_file, result)
+
+    def load_all(self) -> List[Dict]:
+        """Load every stored analysis, ordered by PMID"""
+        return [orjson.loads(data) for data in self._run(self._load_all)]
+
+    def sync_files(self, file_count: int):
+        """
+        Bring the store in line with the analysis files: load files that are new or
+        modified since they were stored (e.g. rewritten by a validator's --fix) and drop
+        rows whose file has been deleted. Skipped, without stat()ing every file, when the
+        summaries directory's mtime and file count match the last recorded sync.
+        """
+        dir_mtime_ns = SUMMARIES_DIR.stat().st_mtime_ns
+        if self._run(self._sync_state) == (dir_mtime_ns, file_count):
+            print("✓ Analysis store up to date (summaries directory unchanged)")
+            return
+
+        analysis_files = scan_analysis_files()
+        stored = self._run(self._mtimes)
+        rows = []
+        for pmid, (path, mtime_ns) in analysis_files.items():
+            if stored.get(pmid) == mtime_ns:
+                continue
+            try:
+                data = Path(path).read_bytes()
+                orjson.loads(data)  # Don't store a file the index export couldn't parse
+            except Exception as e:
+                print(f"Error loading {path}: {e}")
+                continue
+            rows.append((pmid, data, mtime_ns))
+        removed = [pmid for pmid in stored if pmid not in analysis_files]
+
+        # Record the directory mtime from before the scan, so changes during it trigger another sync
+        self._run(self._write, rows, removed, (dir_mtime_ns, len(analysis_files)))
+        print(f"✓ Analysis store synced: {len(rows)} loaded from files, {len(removed)} removed")
+
+    def close(self):
+        """Close the connection (checkpointing the WAL) and stop the store thread"""
+        self._run(self.conn.close)
+        self.executor.shutdown()
+
+
+def write_index(analyses: List[Dict]):
+    """Write the master index atomically"""
+    # Write to a temp file and rename so an interrupted run never leaves a partial index
+    tmp_file = INDEX_FILE.with_suffix('.json.tmp')
+    tmp_file.write_bytes(orjson.dumps(analyses, option=orjson.OPT_INDENT_2))
+    os.replace(tmp_file, INDEX_FILE)
 
 
 class ParallelArticleProcessor:
     """Process articles in parallel using async Claude API"""
 
-    def __init__(self, api_key: str):
-        """Initialize processor with Claude API key"""
-        self.client = AsyncAnthropic(api_key=api_key)
+    def __init__(self, client: AsyncAnthropic, store: AnalysisStore, xml_pool: Optional[Executor] = None):
+        """Initialize processor with a shared Claude client, result store and optional XML parsing pool"""
+        self.client = client
         self.model = "claude-sonnet-4-20250514"
         self.semaphore = asyncio.Semaphore(MAX_CONCURRENT_ARTICLES)
+        self.batch_semaphore = asyncio.Semaphore(MAX_CONCURRENT_BATCH_SUBMITS)
+        self.request_limiter = TokenRateLimiter(MAX_REQUESTS_PER_SECOND, time_period=1)
+        self.token_limiter = TokenRateLimiter(TOKENS_PER_MINUTE, time_period=60)
+        self.cached_articles = set()  # Hashes of article prefixes already written to the prompt cache
+        self.xml_pool = xml_pool  # None falls back to the default thread pool
+        self.store = store
 
     def extract_pmid_from_filename(self, filename: str) -> Optional[str]:
         """Extract PMID from filename"""
-        match = re.search(r'PMID(\d+)', filename)
+        match = PMID_RE.search(filename)
         return match.group(1) if match else None
 
-    def clean_xml_text(self, xml_path: Path) -> Dict[str, str]:
-        """Extract and clean text sections from XML article"""
-        try:
-            tree = ET.parse(xml_path)
-            root = tree.getroot()
-
-            # Extract title
-            title_elem = root.find('.//article-title')
-            title = ""
-            if title_elem is not None:
-                title_parts = []
-                for text in title_elem.itertext():
-                    if text.strip():
-                        title_parts.append(text.strip())
-                title = ' '.join(title_parts)
-
-            # Extract abstract
-            abstract_parts = []
-            for abstract in root.findall('.//abstract'):
-                for elem in abstract.iter():
-                    if elem.text and elem.text.strip():
-                        abstract_parts.append(elem.text.strip())
-                    if elem.tail and elem.tail.strip():
-                        abstract_parts.append(elem.tail.strip())
-            abstract = ' '.join(abstract_parts)
-
-            # Extract body text
-            body_parts = []
-            for body in root.findall('.//body'):
-                for elem in body.iter():
-                    if elem.text and elem.text.strip():
-                        body_parts.append(elem.text.strip())
-                    if elem.tail and elem.tail.strip():
-                        body_parts.append(elem.tail.strip())
-            body = ' '.join(body_parts)
-
-            # Clean up whitespace
-            title = re.sub(r'\s+', ' ', title).strip()
-            abstract = re.sub(r'\s+', ' ', abstract).strip()
-            body = re.sub(r'\s+', ' ', body).strip()
-
-            return {'title': title, 'abstract': abstract, 'body': body}
-
-        except Exception as e:
-            print(f"    ✗ Error parsing XML: {e}")
-            return {'title': '', 'abstract': '', 'body': ''}
-
-    async def stage1_clean_text(self, text_sections: Dict[str, str]) -> str:
-        """Stage 1: Clean and prepare text"""
-        combined_text = f"""Title: {text_sections['title']}
-
-Abstract:
-{text_sections['abstract']}
-
-Full Text:
-{text_sections['body']}"""
-
-        max_chars = 300000
-        if len(combined_text) > max_chars:
-            combined_text = combined_text[:max_chars] + "\n\n[Article truncated]"
-
-        prompt = """You are a scientific text cleaning assistant. Clean and format this scientific article text.
+    def build_content(self, article_text: str, instruction: str) -> List[Dict]:
+        """
+        Build message content with the article first, marked for prompt caching,
+        so every stage after the first reads the article from cache
+        """
+        # The label is its own block so the (large) article string is sent without copying
+        return [
+            {"type": "text", "text": "Article text:"},
+            {"type": "text", "text": article_text, "cache_control": {"type": "ephemeral"}},
+            {"type": "text", "text": instruction}
+        ]
+
+    async def call_claude(self, article_text: str, instruction: str, max_tokens: int,
+                          stop_after_json: Optional[str] = None) -> str:
+        """
+        Send one stage instruction against the shared cached article text.
+        With stop_after_json (the expected JSON value's opening bracket), stream the response
+        and return only that JSON value as soon as it is complete.
+        """
+        # Cache reads don't count against the input token limit, so only charge the article once
+        article_key = hash(article_text)
+        estimated_tokens = len(instruction) // CHARS_PER_TOKEN
+        if article_key not in self.cached_articles:
+            estimated_tokens += len(article_text) // CHARS_PER_TOKEN
+
+        await self.request_limiter.acquire()
+        await self.token_limiter.acquire(estimated_tokens)
+
+        messages = [{"role": "user", "content": self.build_content(article_text, instruction)}]
+        if stop_after_json:
+            response_text = await self.stream_until_json_end(messages, max_tokens, stop_after_json)
+        else:
+            response = await self.client.messages.create(
+                model=self.model,
+                max_tokens=max_tokens,
+                messages=messages
+            )
+            response_text = response.content[0].text
+        self.cached_articles.add(article_key)
+        return response_text
+
+    async def stream_until_json_end(self, messages: List[Dict], max_tokens: int, opener: str) -> str:
+        """
+        Stream a response, closing it as soon as a top-level JSON value starting with `opener`
+        is complete. Bracketed text that isn't valid JSON is skipped and the same stream read on.
+        Returns the JSON text, or the full response if no such value was found.
+        """
+        scanner = JsonScanner(opener)
+        async with self.client.messages.stream(model=self.model, max_tokens=max_tokens,
+                                               messages=messages) as stream:
+            async for chunk in stream.text_stream:
+                json_text = scanner.feed(chunk)
+                if json_text is not None:
+                    # Leaving the context manager closes the stream early
+                    return json_text
+
+        return scanner.text()
+
+    def build_stage1_instruction(self) -> str:
+        """Build the stage 1 text cleaning instruction"""
+        return """You are a scientific text cleaning assistant. Clean and format the scientific article text above.
 
 Remove:
 - XML artifacts and encoding issues
@@ -123,27 +458,21 @@ Keep:
 - Experimental methods and results
 - All measurements and data
 
-Return the cleaned text in a clear, readable format with proper paragraphs. Keep all technical and scientific content intact.
-
-Article text:
-""" + combined_text
+Return the cleaned text in a clear, readable format with proper paragraphs. Keep all technical and scientific content intact."""
 
+    async def stage1_clean_text(self, article_text: str) -> str:
+        """Stage 1: Clean and prepare text"""
         try:
-            response = await self.client.messages.create(
-                model=self.model,
-                max_tokens=8192,
-                messages=[{"role": "user", "content": prompt}]
-            )
-            return response.content[0].text
+            return await self.call_claude(article_text, self.build_stage1_instruction(), STAGE_MAX_TOKENS[1])
         except Exception as e:
             print(f"      ✗ Stage 1 error: {e}")
-            return combined_text
+            return article_text
 
-    async def stage2_comprehensive_summary(self, cleaned_text: str, pmid: str) -> str:
-        """Stage 2: Write comprehensive 1-2 page summary"""
-        prompt = f"""You are a scientific writer specializing in rumen fermentation and methane reduction research.
+    def build_stage2_instruction(self, pmid: str) -> str:
+        """Build the stage 2 summary instruction"""
+        return f"""You are a scientific writer specializing in rumen fermentation and methane reduction research.
 
-Write a comprehensive 1-2 page summary of this scientific article. Your summary should include:
+Write a comprehensive 1-2 page summary of the scientific article above. Your summary should include:
 
 1. **Background & Context**: What problem does this research address?
 2. **Research Objectives**: What were the specific goals or hypotheses?
@@ -155,29 +484,23 @@ Write a comprehensive 1-2 page summary of this scientific article. Your summary
 
 Write in clear, technical prose suitable for researchers in the field. Focus on scientific accuracy and completeness.
 
-Article text:
-{cleaned_text}
-
 PMID: {pmid}
 
 Write your comprehensive summary below:"""
 
+    async def stage2_comprehensive_summary(self, article_text: str, pmid: str) -> str:
+        """Stage 2: Write comprehensive 1-2 page summary"""
         try:
-            response = await self.client.messages.create(
-                model=self.model,
-                max_tokens=4096,
-                messages=[{"role": "user", "content": prompt}]
-            )
-            return response.content[0].text
+            return await self.call_claude(article_text, self.build_stage2_instruction(pmid), STAGE_MAX_TOKENS[2])
         except Exception as e:
             print(f"      ✗ Stage 2 error: {e}")
             return ""
 
-    async def stage3_extract_molecules(self, cleaned_text: str) -> List[str]:
-        """Stage 3: Extract ALL molecules"""
-        prompt = """You are a chemistry expert specializing in identifying chemical compounds in scientific literature.
+    def build_stage3_instruction(self) -> str:
+        """Build the stage 3 molecule extraction instruction"""
+        return """You are a chemistry expert specializing in identifying chemical compounds in scientific literature.
 
-Your task: Extract EVERY chemical compound, molecule, substrate, additive, or metabolite mentioned in this article.
+Your task: Extract EVERY chemical compound, molecule, substrate, additive, or metabolite mentioned in the article above.
 
 Include:
 - **Chemical names**: nitrate, fumarate, 3-nitrooxypropanol (3-NOP), bromochloromethane, etc.
@@ -194,32 +517,28 @@ Include:
 Be EXTREMELY thorough - this is critical data. Scan the entire article carefully.
 
 Return ONLY a JSON array of molecules:
-["molecule1", "molecule2", "molecule3", ...]
+["molecule1", "molecule2", "molecule3", ...]"""
 
-Article text:
-""" + cleaned_text
+    def parse_molecules(self, response_text: str) -> List[str]:
+        """Parse the JSON array of molecules from a stage 3 response"""
+        molecules = parse_json_value(response_text, '[', ']')
+        return molecules if molecules is not None else []
 
+    async def stage3_extract_molecules(self, article_text: str) -> List[str]:
+        """Stage 3: Extract ALL molecules"""
         try:
-            response = await self.client.messages.create(
-                model=self.model,
-                max_tokens=4096,
-                messages=[{"role": "user", "content": prompt}]
-            )
-
-            response_text = response.content[0].text
-            json_match = re.search(r'\[.*\]', response_text, re.DOTALL)
-            if json_match:
-                return json.loads(json_match.group())
-            return []
+            response_text = await self.call_claude(article_text, self.build_stage3_instruction(),
+                                                   STAGE_MAX_TOKENS[3], stop_after_json='[')
+            return self.parse_molecules(response_text)
         except Exception as e:
             print(f"      ✗ Stage 3 error: {e}")
             return []
 
-    async def stage4_extract_topics_keywords(self, cleaned_text: str, pmid: str) -> Dict:
-        """Stage 4: Extract topics and keywords"""
-        prompt = f"""You are a research librarian specializing in animal science and rumen microbiology.
+    def build_stage4_instruction(self, pmid: str) -> str:
+        """Build the stage 4 topics/keywords instruction"""
+        return f"""You are a research librarian specializing in animal science and rumen microbiology.
 
-Analyze this article and extract:
+Analyze the article above and extract:
 
 1. **topics**: 5-8 SHORT topic tags (1-3 words each) that categorize this research
    - Use hyphens for multi-word topics (e.g., "methane-reduction", "in-vitro-fermentation")
@@ -236,116 +555,270 @@ Return ONLY valid JSON:
   "pmid": "{pmid}",
   "topics": ["topic-1", "topic-2", ...],
   "keywords": ["keyword1", "keyword2", ...]
-}}
+}}"""
 
-Article text:
-{cleaned_text}"""
+    def parse_topics_keywords(self, response_text: str, pmid: str) -> Dict:
+        """Parse the topics/keywords JSON object from a stage 4 response"""
+        topics_keywords = parse_json_value(response_text, '{', '}')
+        return topics_keywords if topics_keywords is not None else {"pmid": pmid, "topics": [], "keywords": []}
 
+    async def stage4_extract_topics_keywords(self, article_text: str, pmid: str) -> Dict:
+        """Stage 4: Extract topics and keywords"""
         try:
-            response = await self.client.messages.create(
-                model=self.model,
-                max_tokens=2048,
-                messages=[{"role": "user", "content": prompt}]
-            )
-
-            response_text = response.content[0].text
-            json_match = re.search(r'\{.*\}', response_text, re.DOTALL)
-            if json_match:
-                return json.loads(json_match.group())
-            return {"pmid": pmid, "topics": [], "keywords": []}
+            response_text = await self.call_claude(article_text, self.build_stage4_instruction(pmid),
+                                                   STAGE_MAX_TOKENS[4], stop_after_json='{')
+            return self.parse_topics_keywords(response_text, pmid)
         except Exception as e:
             print(f"      ✗ Stage 4 error: {e}")
             return {"pmid": pmid, "topics": [], "keywords": []}
 
+    async def prepare_article(self, xml_path: Path, article_num: int, total: int) -> Optional[Tuple[str, Dict[str, str]]]:
+        """Resolve the PMID and extract text, or return None if the article should be skipped"""
+        pmid = self.extract_pmid_from_filename(xml_path.name)
+        if not pmid:
+            print(f"[{article_num}/{total}] ✗ Could not extract PMID from: {xml_path.name}")
+            return None
+
+        print(f"\n[{article_num}/{total}] 🔄 Processing PMID {pmid} ({xml_path.name})")
+
+        # Extract raw text (CPU-bound, runs in the XML pool)
+        loop = asyncio.get_running_loop()
+        text_sections = await loop.run_in_executor(self.xml_pool, clean_xml_text, str(xml_path))
+        if not text_sections['body'] or len(text_sections['body']) < 500:
+            print(f"    ✗ Insufficient text")
+            return None
+
+        print(f"    ✓ Extracted text (Title={len(text_sections['title'])}, "
+              f"Abstract={len(text_sections['abstract'])}, Body={len(text_sections['body'])})")
+
+        return pmid, text_sections
+
+    def build_article_text(self, text_sections: Dict[str, str]) -> str:
+        """Build the article text shared by all stages, truncated to MAX_ARTICLE_CHARS"""
+        header = f"Title: {text_sections['title']}\n\nAbstract: {text_sections['abstract']}\n\n"
+        body = text_sections['body']
+        if len(header) + len(body) <= MAX_ARTICLE_CHARS:
+            return ''.join((header, body))
+
+        # Slice the parts before joining so the untruncated text is never materialized
+        body_chars = max(0, MAX_ARTICLE_CHARS - len(header))
+        return ''.join((header[:MAX_ARTICLE_CHARS], body[:body_chars], "\n\n[Article truncated]"))
+
+    def result_sections(self, text_sections: Dict[str, str]) -> Dict:
+        """Keep only the parts of the extracted text that save_result needs"""
+        return {
+            'title': text_sections['title'],
+            'abstract': text_sections['abstract'],
+            'body_length': len(text_sections['body'])
+        }
+
+    def save_result(self, xml_path: Path, pmid: str, text_sections: Dict,
+                    cleaned_text, summary, molecules, topics_keywords, elapsed: float) -> Dict:
+        """Compile stage outputs into the analysis record and save it"""
+        # Handle any errors
+        if isinstance(cleaned_text, Exception):
+            cleaned_text = ""
+        if isinstance(summary, Exception):
+            summary = ""
+        if isinstance(molecules, Exception):
+            molecules = []
+        if isinstance(topics_keywords, Exception):
+            topics_keywords = {"pmid": pmid, "topics": [], "keywords": []}
+
+        # Compile results
+        result = {
+            'pmid': pmid,
+            'xml_file': str(xml_path.name),
+            'title': text_sections['title'],
+            'abstract': text_sections['abstract'],
+            'comprehensive_summary': summary,
+            'topics': topics_keywords.get('topics', []),
+            'keywords': topics_keywords.get('keywords', []),
+            'molecules': molecules,
+            'text_length': {
+                'title': len(text_sections['title']),
+                'abstract': len(text_sections['abstract']),
+                'body': text_sections['body_length'],
+                'cleaned': len(cleaned_text) if isinstance(cleaned_text, str) else 0
+            },
+            'processing_time_seconds': round(elapsed, 2)
+        }
+
+        # Save result, recording it in the store right away so the index survives a crash
+        self.store.save(SUMMARIES_DIR / f"PMID{pmid}_analysis.json", result)
+
+        print(f"    ✓ PMID {pmid} complete in {elapsed:.1f}s | Summary: {len(summary)} chars | "
+              f"Topics: {len(result['topics'])} | Keywords: {len(result['keywords'])} | "
+              f"Molecules: {len(molecules)}")
+
+        return result
+
     async def process_article(self, xml_path: Path, article_num: int, total: int) -> Optional[Dict]:
-        """Process a single article through all stages in parallel"""
+        """Process a single article: stage 4 first to warm the prompt cache, then stages 1-3 in parallel"""
 
         async with self.semaphore:  # Limit concurrent articles
-            pmid = self.extract_pmid_from_filename(xml_path.name)
-            if not pmid:
-                print(f"[{article_num}/{total}] ✗ Could not extract PMID from: {xml_path.name}")
+            prepared = await self.prepare_article(xml_path, article_num, total)
+            if not prepared:
                 return None
+            pmid, text_sections = prepared
 
-            output_file = SUMMARIES_DIR / f"PMID{pmid}_analysis.json"
-            if output_file.exists():
-                print(f"[{article_num}/{total}] ⏭️  Already processed: PMID {pmid}")
-                return None
-
-            print(f"\n[{article_num}/{total}] 🔄 Processing PMID {pmid} ({xml_path.name})")
-
-            # Extract raw text (synchronous)
-            text_sections = self.clean_xml_text(xml_path)
-            if not text_sections['body'] or len(text_sections['body']) < 500:
-                print(f"    ✗ Insufficient text")
-                return None
-
-            print(f"    ✓ Extracted text (Title={len(text_sections['title'])}, "
-                  f"Abstract={len(text_sections['abstract'])}, Body={len(text_sections['body'])})")
+            article_text = self.build_article_text(text_sections)
 
-            # Run all 4 stages in parallel!
-            print(f"    🚀 Running 4 stages in parallel...")
+            # Stage 4 has the shortest output, so run it first to write the article to the cache
+            print(f"    🚀 Warming prompt cache, then running 3 stages in parallel...")
             start_time = time.time()
+            topics_keywords = await self.stage4_extract_topics_keywords(article_text, pmid)
 
             results = await asyncio.gather(
-                self.stage1_clean_text(text_sections),
-                self.stage2_comprehensive_summary(
-                    f"Title: {text_sections['title']}\n\nAbstract: {text_sections['abstract']}\n\n{text_sections['body']}",
-                    pmid
-                ),
-                self.stage3_extract_molecules(
-                    f"Title: {text_sections['title']}\n\nAbstract: {text_sections['abstract']}\n\n{text_sections['body']}"
-                ),
-                self.stage4_extract_topics_keywords(
-                    f"Title: {text_sections['title']}\n\nAbstract: {text_sections['abstract']}\n\n{text_sections['body']}",
-                    pmid
-                ),
+                self.stage1_clean_text(article_text),
+                self.stage2_comprehensive_summary(article_text, pmid),
+                self.stage3_extract_molecules(article_text),
                 return_exceptions=True
             )
 
-            cleaned_text, summary, molecules, topics_keywords = results
+            cleaned_text, summary, molecules = results
             elapsed = time.time() - start_time
 
-            # Handle any errors
-            if isinstance(cleaned_text, Exception):
-                cleaned_text = ""
-            if isinstance(summary, Exception):
-                summary = ""
-            if isinstance(molecules, Exception):
+            # Save on the default thread pool (I/O bound)
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(None, self.save_result, xml_path, pmid,
+                                              self.result_sections(text_sections),
+                                              cleaned_text, summary, molecules, topics_keywords, elapsed)
+
+    async def submit_batch(self, articles: List[Tuple[Path, str, Dict[str, str]]]) -> str:
+        """Submit stages 1-4 for every article as a single Message Batches job"""
+        requests = []
+        for _, pmid, text_sections in articles:
+            article_text = self.build_article_text(text_sections)
+            instructions = {
+                1: self.build_stage1_instruction(),
+                2: self.build_stage2_instruction(pmid),
+                3: self.build_stage3_instruction(),
+                4: self.build_stage4_instruction(pmid),
+            }
+            for stage, instruction in instructions.items():
+                requests.append({
+                    "custom_id": f"{pmid}-stage{stage}",  # Must match ^[a-zA-Z0-9_-]{1,64}$
+                    "params": {
+                        "model": self.model,
+                        "max_tokens": STAGE_MAX_TOKENS[stage],
+                        "messages": [{"role": "user", "content": self.build_content(article_text, instruction)}]
+                    }
+                })
+
+        batch = await self.client.messages.batches.create(requests=requests)
+        print(f"  📦 Submitted batch {batch.id}: {len(articles)} articles, {len(requests)} requests")
+        return batch.id
+
+    async def wait_for_batch(self, batch_id: str):
+        """Poll a batch job with exponential backoff until it has ended"""
+        delay = BATCH_POLL_INITIAL
+        while True:
+            batch = await self.client.messages.batches.retrieve(batch_id)
+            if batch.processing_status == "ended":
+                return batch
+            counts = batch.request_counts
+            print(f"  ⏳ Batch {batch_id}: {counts.processing} processing, {counts.succeeded} succeeded, "
+                  f"{counts.errored} errored (next check in {delay}s)")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, BATCH_POLL_MAX)
+
+    async def process_batch_job(self, batch_id: str, articles: List[Tuple[Path, str, Dict]],
+                                start_time: float) -> List:
+        """
+        Wait for a submitted batch job and save a result per article. Articles with a stage
+        that didn't succeed get an exception instead, so they are retried on the next run
+        """
+        await self.wait_for_batch(batch_id)
+        elapsed = time.time() - start_time
+
+        # Collect response text per PMID and stage
+        outputs: Dict[str, Dict[int, str]] = {}
+        async for entry in await self.client.messages.batches.results(batch_id):
+            pmid, stage = entry.custom_id.rsplit("-stage", 1)
+            if entry.result.type == "succeeded":
+                outputs.setdefault(pmid, {})[int(stage)] = entry.result.message.content[0].text
+            else:
+                print(f"      ✗ PMID {pmid} stage {stage} {entry.result.type}")
+
+        loop = asyncio.get_running_loop()
+        results = []
+        for xml_path, pmid, sections in articles:
+            stage_text = outputs.get(pmid, {})
+            missing = sorted({1, 2, 3, 4} - stage_text.keys())
+            if missing:
+                results.append(RuntimeError(f"PMID {pmid}: batch stage(s) {missing} did not succeed"))
+                continue
+
+            try:
+                molecules = self.parse_molecules(stage_text[3])
+            except Exception as e:
+                print(f"      ✗ Stage 3 error: {e}")
                 molecules = []
-            if isinstance(topics_keywords, Exception):
+            try:
+                topics_keywords = self.parse_topics_keywords(stage_text[4], pmid)
+            except Exception as e:
+                print(f"      ✗ Stage 4 error: {e}")
                 topics_keywords = {"pmid": pmid, "topics": [], "keywords": []}
 
-            # Compile results
-            result = {
-                'pmid': pmid,
-                'xml_file': str(xml_path.name),
-                'title': text_sections['title'],
-                'abstract': text_sections['abstract'],
-                'comprehensive_summary': summary,
-                'topics': topics_keywords.get('topics', []),
-                'keywords': topics_keywords.get('keywords', []),
-                'molecules': molecules,
-                'text_length': {
-                    'title': len(text_sections['title']),
-                    'abstract': len(text_sections['abstract']),
-                    'body': len(text_sections['body']),
-                    'cleaned': len(cleaned_text) if isinstance(cleaned_text, str) else 0
-                },
-                'processing_time_seconds': round(elapsed, 2)
-            }
+            # Save on the default thread pool (I/O bound) so other jobs keep polling
+            results.append(await loop.run_in_executor(
+                None, self.save_result, xml_path, pmid, sections,
+                stage_text[1], stage_text[2], molecules, topics_keywords, elapsed
+            ))
 
-            # Save result
-            with open(output_file, 'w', encoding='utf-8') as f:
-                json.dump(result, f, indent=2, ensure_ascii=False)
+        return results
 
-            print(f"    ✓ Complete in {elapsed:.1f}s | Summary: {len(summary)} chars | "
-                  f"Topics: {len(result['topics'])} | Keywords: {len(result['keywords'])} | "
-                  f"Molecules: {len(molecules)}")
+    async def process_batch_chunk(self, xml_files: List[Path], first_num: int, total: int) -> List:
+        """
+        Prepare one chunk of articles and run it as a batch job. Returns one entry per
+        XML file: the saved result, None if skipped, or an exception if it failed
+        """
+        def is_prepared(prepared) -> bool:
+            return bool(prepared) and not isinstance(prepared, Exception)
 
-            return result
+        try:
+            # Only MAX_CONCURRENT_BATCH_SUBMITS chunks hold full article text at any time;
+            # submitted jobs then wait server-side without holding the semaphore
+            async with self.batch_semaphore:
+                prepared_articles = await asyncio.gather(*[
+                    self.prepare_article(xml_path, idx, total)
+                    for idx, xml_path in enumerate(xml_files, first_num)
+                ], return_exceptions=True)
+                articles = [
+                    (xml_path, prepared[0], prepared[1])
+                    for xml_path, prepared in zip(xml_files, prepared_articles)
+                    if is_prepared(prepared)
+                ]
+                if not articles:
+                    return list(prepared_articles)
+
+                start_time = time.time()
+                batch_id = await self.submit_batch(articles)
+                articles = [(xml_path, pmid, self.result_sections(text_sections))
+                            for xml_path, pmid, text_sections in articles]
+
+            saved = iter(await self.process_batch_job(batch_id, articles, start_time))
+        except Exception as e:
+            print(f"  ✗ Batch job failed: {e}")
+            return [e if is_prepared(prepared) else prepared for prepared in prepared_articles]
 
+        return [next(saved) if is_prepared(prepared) else prepared for prepared in prepared_articles]
 
-async def process_all_articles():
+    async def process_all_batched(self, xml_files: List[Path]) -> List:
+        """Process articles through the Message Batches API, one job per BATCH_ARTICLES articles"""
+        chunk_starts = range(0, len(xml_files), BATCH_ARTICLES)
+        print(f"\nSubmitting {len(xml_files)} articles as {len(chunk_starts)} batch job(s), "
+              f"preparing {MAX_CONCURRENT_BATCH_SUBMITS} at a time")
+
+        job_results = await asyncio.gather(*[
+            self.process_batch_chunk(xml_files[start:start + BATCH_ARTICLES], start + 1, len(xml_files))
+            for start in chunk_starts
+        ])
+        return [result for job_result in job_results for result in job_result]
+
+
+async def process_all_articles(use_batch_api: bool = False):
     """Process all articles with parallelization"""
     print("="*80)
     print("Parallel Multi-Stage Article Processing with Claude AI")
@@ -354,8 +827,7 @@ async def process_all_articles():
     # Test Claude API
     print("Testing Claude API connection...")
     try:
-        test_client = AsyncAnthropic(api_key=CLAUDE_API_KEY)
-        test_response = await test_client.messages.create(
+        await CLIENT.messages.create(
             model="claude-sonnet-4-20250514",
             max_tokens=50,
             messages=[{"role": "user", "content": "Reply: OK"}]
@@ -366,67 +838,92 @@ async def process_all_articles():
         return
 
     # Get XML files
-    xml_files = list(XML_DIR.glob("*.xml"))
-    if not xml_files:
+    all_xml_files = list(XML_DIR.glob("*.xml"))
+    if not all_xml_files:
         print(f"No XML files found in {XML_DIR}")
         return
 
-    print(f"Found {len(xml_files)} XML files")
-    print(f"Processing {MAX_CONCURRENT_ARTICLES} articles in parallel")
-    print(f"Each article runs 4 stages concurrently\n")
-
-    # Initialize processor
-    processor = ParallelArticleProcessor(api_key=CLAUDE_API_KEY)
-
-    # Process all articles
-    start_time = time.time()
-    tasks = [
-        processor.process_article(xml_path, idx, len(xml_files))
-        for idx, xml_path in enumerate(xml_files, 1)
-    ]
-
-    results = await asyncio.gather(*tasks, return_exceptions=True)
-
-    # Count results
-    processed = sum(1 for r in results if r is not None and not isinstance(r, Exception))
-    skipped = sum(1 for r in results if r is None)
-    errors = sum(1 for r in results if isinstance(r, Exception))
-
-    elapsed = time.time() - start_time
-
-    # Summary
-    print("\n" + "="*80)
-    print("Processing Complete!")
-    print("="*80)
-    print(f"Total files: {len(xml_files)}")
-    print(f"Processed: {processed}")
-    print(f"Skipped: {skipped}")
-    print(f"Errors: {errors}")
-    print(f"Total time: {elapsed/60:.1f} minutes")
-    print(f"Avg per article: {elapsed/len(xml_files):.1f} seconds")
-    print(f"\nResults saved to: {SUMMARIES_DIR}/")
-    print("="*80)
-
-    # Create index
-    print("\nCreating master index...")
-    all_analyses = []
-    for analysis_file in SUMMARIES_DIR.glob("PMID*_analysis.json"):
-        try:
-            with open(analysis_file, 'r', encoding='utf-8') as f:
-                all_analyses.append(json.load(f))
-        except Exception as e:
-            print(f"Error loading {analysis_file}: {e}")
-
-    if all_analyses:
-        index_file = SUMMARIES_DIR / "all_analyses_index.json"
-        with open(index_file, 'w', encoding='utf-8') as f:
-            json.dump(all_analyses, f, indent=2, ensure_ascii=False)
-        print(f"✓ Master index created: {len(all_analyses)} articles")
+    # Drop already-processed articles before scheduling any work
+    done_pmids = find_processed_pmids()
+    xml_files = []
+    for xml_path in all_xml_files:
+        match = PMID_RE.search(xml_path.name)
+        if match and match.group(1) in done_pmids:
+            continue
+        xml_files.append(xml_path)
+
+    # Largest first so long articles don't straggle at the end
+    xml_files.sort(key=lambda p: p.stat().st_size, reverse=True)
+
+    print(f"Found {len(all_xml_files)} XML files ({len(all_xml_files) - len(xml_files)} already processed)")
+    if use_batch_api:
+        print(f"Using Message Batches API ({BATCH_ARTICLES} articles per batch job)\n")
+    else:
+        print(f"Processing {MAX_CONCURRENT_ARTICLES} articles in parallel")
+        print(f"Each article runs stage 4 first (warms the prompt cache), then stages 1-3 concurrently\n")
+
+    # Initialize processor; XML parsing is CPU-bound so it gets its own process pool
+    xml_pool = ProcessPoolExecutor(max_workers=os.cpu_count())
+    store = AnalysisStore(ANALYSES_DB)
+    try:
+        store.sync_files(len(done_pmids))
+        processor = ParallelArticleProcessor(client=CLIENT, store=store, xml_pool=xml_pool)
+
+        # Process all articles
+        start_time = time.time()
+        if use_batch_api:
+            results = await processor.process_all_batched(xml_files)
+        else:
+            tasks = [
+                processor.process_article(xml_path, idx, len(xml_files))
+                for idx, xml_path in enumerate(xml_files, 1)
+            ]
+            results = await asyncio.gather(*tasks, return_exceptions=True)
+
+        # Count results
+        processed = sum(1 for r in results if r is not None and not isinstance(r, Exception))
+        skipped = sum(1 for r in results if r is None)
+        errors = sum(1 for r in results if isinstance(r, Exception))
+
+        elapsed = time.time() - start_time
+
+        # Summary
+        print("\n" + "="*80)
+        print("Processing Complete!")
+        print("="*80)
+        print(f"Total files: {len(all_xml_files)}")
+        print(f"Already processed: {len(all_xml_files) - len(xml_files)}")
+        print(f"Processed: {processed}")
+        print(f"Skipped: {skipped}")
+        print(f"Errors: {errors}")
+        print(f"Total time: {elapsed/60:.1f} minutes")
+        if xml_files:
+            print(f"Avg per article: {elapsed/len(xml_files):.1f} seconds")
+        print(f"\nResults saved to: {SUMMARIES_DIR}/")
+        print("="*80)
+
+        # Export index from the store in one query
+        print("\nUpdating master index...")
+        analyses = store.load_all()
+
+        if analyses:
+            write_index(analyses)
+            print(f"✓ Master index updated: {len(analyses)} articles")
+    finally:
+        xml_pool.shutdown()
+        store.close()
 
 
 def main():
     """Main entry point"""
-    asyncio.run(process_all_articles())
+
+    import argparse
+    parser = argparse.ArgumentParser(description='Process articles with the multi-stage Claude pipeline')
+    parser.add_argument('--batch', action='store_true',
+                        help='Submit stages through the Message Batches API (50%% cheaper, asynchronous)')
+    args = parser.parse_args()
+
+    asyncio.run(process_all_articles(use_batch_api=args.batch))
 
 
 if __name__ == '__main__':
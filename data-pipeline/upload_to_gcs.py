@@ -5,14 +5,19 @@ Syncs local files to GCS bucket: gs://fixathon26-pubmed-data
 """
 
 import os
+from concurrent.futures import ThreadPoolExecutor
+from enum import Enum
 from pathlib import Path
-from typing import List, Optional
+from typing import List, Optional, Set
 from google.cloud import storage
 from datetime import datetime
 
 # GCS Configuration
 BUCKET_NAME = "fixathon26-pubmed-data"
 
+# Concurrent blob requests per directory (matches the storage client's default HTTP pool size)
+MAX_UPLOAD_WORKERS = 10
+
 # Local directories to upload
 UPLOAD_DIRS = {
     "pubmed-ids-results": "pubmed-ids-results",  # local -> GCS path
@@ -22,6 +27,13 @@ UPLOAD_DIRS = {
 }
 
 
+class UploadResult(Enum):
+    """Outcome of a single file upload"""
+    UPLOADED = "uploaded"
+    SKIPPED = "skipped"
+    ERROR = "error"
+
+
 class GCSUploader:
     """Upload files to Google Cloud Storage"""
 
@@ -49,7 +61,20 @@ class GCSUploader:
         blob = self.bucket.blob(gcs_path)
         return blob.exists()
 
-    def upload_file(self, local_path: Path, gcs_path: str, skip_existing: bool = True) -> bool:
+    def list_existing_blobs(self, gcs_prefix: str) -> Set[str]:
+        """
+        List the names of all blobs under a prefix
+
+        Args:
+            gcs_prefix: Prefix in GCS bucket
+
+        Returns:
+            Set of blob names (one paginated list call instead of a HEAD per file)
+        """
+        return {blob.name for blob in self.client.list_blobs(self.bucket, prefix=f"{gcs_prefix}/")}
+
+    def upload_file(self, local_path: Path, gcs_path: str, skip_existing: bool = True,
+                    existing: Optional[Set[str]] = None) -> UploadResult:
         """
         Upload a single file to GCS
 
@@ -57,23 +82,29 @@ class GCSUploader:
             local_path: Local file path
             gcs_path: Destination path in GCS
             skip_existing: Skip if file already exists in GCS
+            existing: Known blob names from list_existing_blobs (checked instead of querying GCS)
 
         Returns:
-            True if uploaded, False if skipped or error
+            UploadResult.UPLOADED, SKIPPED or ERROR
         """
         # Check if file exists in GCS
-        if skip_existing and self.file_exists_in_gcs(gcs_path):
+        if existing is not None:
+            already_exists = gcs_path in existing
+        else:
+            already_exists = skip_existing and self.file_exists_in_gcs(gcs_path)
+
+        if skip_existing and already_exists:
             print(f"  ⏭️  Skipping (already exists): {gcs_path}")
-            return False
+            return UploadResult.SKIPPED
 
         try:
             blob = self.bucket.blob(gcs_path)
             blob.upload_from_filename(str(local_path))
             print(f"  ✓ Uploaded: {gcs_path}")
-            return True
+            return UploadResult.UPLOADED
         except Exception as e:
             print(f"  ✗ Error uploading {gcs_path}: {e}")
-            return False
+            return UploadResult.ERROR
 
     def upload_directory(self, local_dir: Path, gcs_prefix: str,
                         pattern: str = "*", skip_existing: bool = True) -> tuple:
@@ -108,17 +139,24 @@ class GCSUploader:
 
         print(f"Found {len(files)} files")
 
-        for local_file in files:
+        # Fetch existing blob names once rather than probing each file
+        existing = self.list_existing_blobs(gcs_prefix) if skip_existing else None
+
+        def upload(local_file: Path) -> UploadResult:
             # Create GCS path
             relative_path = local_file.relative_to(local_dir)
             gcs_path = f"{gcs_prefix}/{relative_path}"
 
-            # Upload file
-            result = self.upload_file(local_file, gcs_path, skip_existing)
+            return self.upload_file(local_file, gcs_path, skip_existing, existing)
+
+        # Upload files concurrently; blob requests release the GIL while waiting on the network
+        with ThreadPoolExecutor(max_workers=MAX_UPLOAD_WORKERS) as pool:
+            results = list(pool.map(upload, files))
 
-            if result:
+        for result in results:
+            if result is UploadResult.UPLOADED:
                 uploaded += 1
-            elif skip_existing and self.file_exists_in_gcs(gcs_path):
+            elif result is UploadResult.SKIPPED:
                 skipped += 1
             else:
                 errors += 1
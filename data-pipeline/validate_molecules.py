@@ -5,6 +5,7 @@ Checks if molecules actually exist using PubChem API and standardizes names.
 """
 
 import json
+import os
 import time
 import requests
 from pathlib import Path
@@ -170,8 +171,12 @@ def validate_article_molecules(article_file: Path, validator: MoleculeValidator,
                 'details': validation_results['details']
             }
 
-            with open(article_file, 'w', encoding='utf-8') as f:
-                json.dump(article_data, f, indent=2, ensure_ascii=False)
+            # Write a temp file and rename it over the original, so the file is never left
+            # half-written and the directory mtime changes (process_articles_parallel.py syncs on it)
+            tmp_file = article_file.with_suffix('.json.tmp')
+            with open(tmp_file, 'w', encoding='utf-8') as f:
+                json.dump(article_data, f, ensure_ascii=False, separators=(',', ':'))
+            os.replace(tmp_file, article_file)
 
             print(f"  💾 Updated file with {len(validation_results['valid'])} valid molecules")
 
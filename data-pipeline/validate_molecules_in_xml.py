@@ -5,6 +5,7 @@ Handles special characters like Greek/Latin letters in &#111; format.
 """
 
 import json
+import os
 import re
 from pathlib import Path
 from typing import List, Dict, Set
@@ -135,8 +136,12 @@ def validate_molecules_in_xml(article_file: Path, fix: bool = False) -> Dict:
                 'removed_molecules': invalid_molecules
             }
 
-            with open(article_file, 'w', encoding='utf-8') as f:
-                json.dump(article_data, f, indent=2, ensure_ascii=False)
+            # Write a temp file and rename it over the original, so the file is never left
+            # half-written and the directory mtime changes (process_articles_parallel.py syncs on it)
+            tmp_file = article_file.with_suffix('.json.tmp')
+            with open(tmp_file, 'w', encoding='utf-8') as f:
+                json.dump(article_data, f, ensure_ascii=False, separators=(',', ':'))
+            os.replace(tmp_file, article_file)
 
             print(f"  💾 Updated file - kept {len(valid_molecules)} molecules found in XML")
 